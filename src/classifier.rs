@@ -111,7 +111,11 @@ impl Classifier for Process {
     }
     fn classify(&mut self, metadata: ActiveWindowMetadata) -> Result<Option<String>, ErrorMessage> {
         let escape_field = |field: Option<String>| match field {
-            Some(text) => text.replace(|c| c == '\t' || c == '\n', " "),
+            // Only reallocate if there is something to replace
+            Some(ref text) if text.contains(|c| c == '\t' || c == '\n') => {
+                text.replace(|c| c == '\t' || c == '\n', " ")
+            }
+            Some(text) => text,
             None => String::new(),
         };
         let metadata = format!(
@@ -133,7 +137,7 @@ impl Classifier for Process {
         // Filter
         if line.is_empty() {
             Ok(None)
-        } else if self.categories.contains(&line) {
+        } else if self.categories.index_of(&line).is_some() {
             Ok(Some(line))
         } else {
             Err(ErrorMessage::from(format!(
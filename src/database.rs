@@ -1,11 +1,10 @@
 use super::UniqueCategories;
-use chrono;
-use std;
 use std::fs;
 use std::fs::File;
 use std::io;
-use std::io::{BufRead, BufReader, BufWriter, Read, Seek, Write};
-use std::path::Path;
+use std::io::{BufRead, BufReader, Read, Seek, Write};
+use std::os::unix::fs::FileExt;
+use std::path::{Path, PathBuf};
 use std::time;
 
 // io::Error with InvalidData is used for DB formatting errors. Shorten creation.
@@ -54,6 +53,57 @@ fn seek_to_offset<F: Seek>(f: &mut F, offset: usize) -> io::Result<()> {
     f.seek(io::SeekFrom::Start(offset as u64)).map(|_| ())
 }
 
+/// Name of the first column, which contains the time window starts.
+const TIME_WINDOW_HEADER: &str = "time_window";
+
+/// Header line text (with newline) for the given categories.
+fn header_line(categories: &UniqueCategories) -> String {
+    format!("{}\t{}\n", TIME_WINDOW_HEADER, categories.join("\t"))
+}
+
+/// Sync the directory containing path, so that a newly created file entry is durable.
+fn sync_parent_directory(path: &Path) -> io::Result<()> {
+    let dir = match path.parent() {
+        Some(dir) if dir != Path::new("") => dir,
+        _ => Path::new("."),
+    };
+    File::open(dir)?.sync_all()
+}
+
+/** Replace the content of the file at path, atomically.
+ * Content is written to a temporary file in the same directory, which is then renamed over path.
+ * A crash leaves either the old or the new content, never a mix.
+ * Symlinks are resolved first, so that the real file is replaced and links are kept.
+ * Returns the new file, opened in read write mode.
+ */
+fn replace_file_content(path: &Path, content: &[u8]) -> io::Result<File> {
+    let path = fs::canonicalize(path)?;
+    let temp_path = {
+        let mut name = path.as_os_str().to_owned();
+        name.push(".tmp");
+        PathBuf::from(name)
+    };
+    let write_and_rename = || -> io::Result<()> {
+        let mut temp = fs::OpenOptions::new()
+            .write(true)
+            .create(true)
+            .truncate(true)
+            .open(&temp_path)?;
+        // Keep the permissions of the replaced file
+        temp.set_permissions(fs::metadata(&path)?.permissions())?;
+        temp.write_all(content)?;
+        temp.sync_all()?;
+        fs::rename(&temp_path, &path)
+    };
+    if let Err(err) = write_and_rename() {
+        let _ = fs::remove_file(&temp_path); // Do not leave a partial temporary file
+        return Err(err);
+    }
+    let f = fs::OpenOptions::new().read(true).write(true).open(&path)?;
+    sync_parent_directory(&path)?;
+    Ok(f)
+}
+
 /** Time spent Database.
  * Time spent in each categories is stored by time window, in seconds.
  *
@@ -72,6 +122,8 @@ pub struct Database {
     file: File,
     counts: LineCounts, // After construction, always points to last line of file.
     categories: UniqueCategories,
+    line_buffer: String, // Reused by rewrite_last_entry to avoid an allocation per write.
+    window_start_text: Option<(DatabaseTime, String)>, // Formatted time window of last write
 }
 
 /// Time windows are timezone aware, in system local timezone.
@@ -98,32 +150,38 @@ impl Database {
                         file: reader.into_inner(),
                         counts: counts,
                         categories: db_categories,
+                        line_buffer: String::new(),
+                        window_start_text: None,
                     })
                 } else {
                     // Put file content in memory
                     let mut entry_lines = String::new();
                     reader.read_to_string(&mut entry_lines)?;
                     // Rewrite file TODO scan ? better impl ?
+                    // New content is built in one buffer and replaces the file atomically.
                     let entry_suffix: String = std::iter::repeat("\t0")
                         .take(nb_missing_categories)
                         .collect();
                     let mut counts = LineCounts::new();
-                    let mut writer = BufWriter::new(reader.into_inner());
-                    seek_to_offset(&mut writer, 0)?;
-                    {
-                        let header = format!("time_window\t{}\n", db_categories.join("\t"));
-                        writer.write_all(header.as_bytes())?;
-                        counts.advance(header.len());
-                    }
+                    let mut content = header_line(&db_categories);
+                    let nb_entries = entry_lines.lines().count();
+                    content.reserve(entry_lines.len() + nb_entries * (entry_suffix.len() + 1));
+                    counts.advance(content.len());
                     for entry in entry_lines.lines() {
-                        let new_entry = format!("{}{}\n", entry, entry_suffix);
-                        writer.write_all(new_entry.as_bytes())?;
-                        counts.advance(new_entry.len());
+                        let entry_start = content.len();
+                        content.push_str(entry);
+                        content.push_str(&entry_suffix);
+                        content.push('\n');
+                        counts.advance(content.len() - entry_start);
                     }
+                    drop(reader);
+                    let f = replace_file_content(path, content.as_bytes())?;
                     Ok(Database {
-                        file: writer.into_inner()?,
+                        file: f,
                         counts: counts,
                         categories: db_categories,
+                        line_buffer: String::new(),
+                        window_start_text: None,
                     })
                 }
             }
@@ -136,10 +194,19 @@ impl Database {
 
     /** Create a new empty database with the specified categories.
      * Creates parent directories if needed.
+     * The new file and created directories are synced to disk.
      */
     pub fn create_new(path: &Path, categories: UniqueCategories) -> io::Result<Self> {
         if let Some(dir) = path.parent() {
-            fs::DirBuilder::new().recursive(true).create(dir)?
+            // Directories that will be created: their entries must be synced too.
+            let missing_dirs: Vec<&Path> = dir
+                .ancestors()
+                .take_while(|d| *d != Path::new("") && !d.exists())
+                .collect();
+            fs::DirBuilder::new().recursive(true).create(dir)?;
+            for created_dir in missing_dirs {
+                sync_parent_directory(created_dir)?;
+            }
         }
         let mut f = fs::OpenOptions::new()
             .read(true)
@@ -148,15 +215,19 @@ impl Database {
             .open(path)?;
         let mut counts = LineCounts::new();
         {
-            let header = format!("time_window\t{}\n", categories.join("\t"));
+            let header = header_line(&categories);
             f.write_all(header.as_bytes())?;
             counts.advance(header.len());
         }
+        f.sync_all()?;
+        sync_parent_directory(path)?;
         counts.ignore_last_line(); // Skip header
         Ok(Database {
             file: f,
             counts: counts,
             categories: categories,
+            line_buffer: String::new(),
+            window_start_text: None,
         })
     }
 
@@ -275,19 +346,35 @@ impl Database {
         window_start: &DatabaseTime,
         durations: &[time::Duration],
     ) -> io::Result<()> {
-        // Build line text
-        let mut line = window_start.to_rfc3339();
+        // Time window text only changes with the time window: format it once per window.
+        let is_text_cached = match &self.window_start_text {
+            Some((time, _)) => time == window_start,
+            None => false,
+        };
+        if !is_text_cached {
+            self.window_start_text = Some((*window_start, window_start.to_rfc3339()));
+        }
+        // Build line text in the reused buffer
+        let line = &mut self.line_buffer;
+        line.clear();
+        line.push_str(&self.window_start_text.as_ref().unwrap().1);
         for d in durations {
             use std::fmt::Write;
-            write!(&mut line, "\t{}", d.as_secs()).unwrap();
+            write!(line, "\t{}", d.as_secs()).unwrap();
         }
         line.push('\n');
-        // Write to file, trim excess file len, flush to disk.
-        seek_to_offset(&mut self.file, self.counts.last_line_start_offset)?;
-        self.file.write_all(line.as_bytes())?;
+        // Write to file in place (no seek needed), trim excess file len, flush to disk.
+        // File len is always counts.cursor(), so trimming is only needed if the line shrinks.
+        let previous_line_len = self.counts.last_line_len;
+        self.file
+            .write_all_at(line.as_bytes(), self.counts.last_line_start_offset as u64)?;
         self.counts.last_line_len = line.len();
-        self.file.set_len(self.counts.cursor() as u64)?;
-        self.file.sync_all() // May be costly, but we do not call that often...
+        if line.len() < previous_line_len {
+            self.file.set_len(self.counts.cursor() as u64)?;
+        }
+        // May be costly, but we do not call that often...
+        // Only data and file len matter: fdatasync is enough and skips timestamp updates.
+        self.file.sync_data()
     }
 
     /// Move the last line cursor to the next line, locking the current last line content.
@@ -353,7 +440,8 @@ impl CategoryDurationCounter {
     }
 
     /** Record a change in active window.
-     * Store durations for the previous category up to now, then changes current category.
+     * If the category changed, store durations for the previous category up to now,
+     * then changes current category.
      * Assumes that the category name is in the set given to new().
      */
     pub fn category_changed<S: AsRef<str>>(
@@ -361,14 +449,15 @@ impl CategoryDurationCounter {
         category: Option<S>,
         timestamp: time::Instant,
     ) {
-        self.record_current_duration(timestamp);
-        self.current_category_index = category.map(|s| {
+        let category_index = category.map(|s| {
             self.categories
-                .iter()
-                .enumerate()
-                .find(|(_i, category_name)| category_name.as_str() == s.as_ref())
+                .index_of(s.as_ref())
                 .expect("category name is unknown")
-                .0
         });
+        // Same category: time will be accounted at the next record, nothing to do.
+        if category_index != self.current_category_index {
+            self.record_current_duration(timestamp);
+            self.current_category_index = category_index;
+        }
     }
 }
@@ -4,6 +4,7 @@ extern crate chrono;
 extern crate clap;
 extern crate tokio;
 use std::cell::RefCell;
+use std::collections::HashMap;
 use std::error::Error;
 use std::fmt;
 use std::io;
@@ -11,6 +12,17 @@ use std::path::Path;
 use std::time;
 use tokio::prelude::*;
 
+/// Debug trace on stdout.
+/// Only enabled in debug builds: release builds do no console io on event paths.
+/// Defined before the modules so that they can use it.
+macro_rules! debug_println {
+    ($($arg:tt)*) => {
+        if cfg!(debug_assertions) {
+            println!($($arg)*)
+        }
+    };
+}
+
 /// Generic error type: contains a message and a boxed inner error if applicable.
 #[derive(Debug)]
 pub struct ErrorMessage {
@@ -52,48 +64,72 @@ impl Error for ErrorMessage {
 }
 
 /// Store a set of unique category names, in a specific order.
+/// Also indexes the names to get their position without scanning.
 #[derive(Debug, Clone)]
-pub struct UniqueCategories(Vec<String>);
+pub struct UniqueCategories {
+    names: Vec<String>,
+    indexes: HashMap<String, usize>,
+}
 impl UniqueCategories {
     /// Check if given vec has unique elements
     pub fn from_unique(categories: Vec<String>) -> Result<Self, ErrorMessage> {
-        for category in &categories {
-            if categories.iter().filter(|c| *c == category).count() > 1 {
+        let mut indexes = HashMap::with_capacity(categories.len());
+        for (i, category) in categories.iter().enumerate() {
+            if indexes.insert(category.clone(), i).is_some() {
                 return Err(ErrorMessage::from(format!(
                     "Duplicate category '{}'",
                     category
                 )));
             }
         }
-        Ok(UniqueCategories(categories))
+        Ok(UniqueCategories {
+            names: categories,
+            indexes: indexes,
+        })
     }
     /// Make given vec unique. Order is not conserved.
     pub fn make_unique(mut categories: Vec<String>) -> Self {
         categories.sort();
         categories.dedup();
-        UniqueCategories(categories)
+        UniqueCategories::with_indexes(categories)
     }
     /// Extend current vec with new categories only. Return slice to inserted elements.
     pub fn extend(&mut self, categories: UniqueCategories) -> usize {
-        let v = &mut self.0;
-        let initial_len = v.len();
-        for c in categories.0 {
-            if !v[..initial_len].contains(&c) {
-                v.push(c);
+        let initial_len = self.names.len();
+        for c in categories.names {
+            if !self.indexes.contains_key(&c) {
+                self.indexes.insert(c.clone(), self.names.len());
+                self.names.push(c);
             }
         }
-        v.len() - initial_len
+        self.names.len() - initial_len
+    }
+    /// Position of a category name, if present.
+    pub fn index_of(&self, category: &str) -> Option<usize> {
+        self.indexes.get(category).cloned()
+    }
+    /// Build the name index. Names must be unique.
+    fn with_indexes(names: Vec<String>) -> Self {
+        let indexes = names
+            .iter()
+            .enumerate()
+            .map(|(i, name)| (name.clone(), i))
+            .collect();
+        UniqueCategories {
+            names: names,
+            indexes: indexes,
+        }
     }
 }
 impl std::ops::Deref for UniqueCategories {
     type Target = [String];
     fn deref(&self) -> &[String] {
-        &self.0
+        &self.names
     }
 }
 
 /// Metadata for the current active window
-#[derive(Debug)]
+#[derive(Debug, Clone, PartialEq)]
 pub struct ActiveWindowMetadata {
     title: Option<String>,
     class: Option<String>,
@@ -125,7 +161,7 @@ fn change_time_window(
     db: &mut Database,
     duration_counter: &mut CategoryDurationCounter,
     window_start: &mut DatabaseTime,
-    time_window_size: time::Duration,
+    time_window_duration: chrono::Duration,
     timestamp: time::Instant,
 ) -> io::Result<()> {
     // Flush current durations values
@@ -133,7 +169,7 @@ fn change_time_window(
     // Create a new time window
     db.lock_last_entry();
     duration_counter.reset_durations();
-    *window_start = *window_start + chrono::Duration::from_std(time_window_size).unwrap();
+    *window_start = *window_start + time_window_duration;
     Ok(())
 }
 
@@ -144,21 +180,24 @@ fn run_daemon(
     time_window_size: time::Duration,
 ) -> Result<(), ErrorMessage> {
     let db_filename = db_file.display();
+    // Window size as used in time window arithmetic, converted once.
+    let time_window_duration = chrono::Duration::from_std(time_window_size).unwrap();
     // Setup state
     let classifier_categories = classifier.categories();
     let mut db = Database::open(db_file, classifier_categories)
         .map_err(|e| ErrorMessage::new(format!("Unable to open database '{}'", db_filename), e))?;
     let mut duration_counter = CategoryDurationCounter::new(db.categories().clone());
-    let active_window_changes = ActiveWindowChanges::new()
+    let mut active_window_changes = ActiveWindowChanges::new()
         .map_err(|e| ErrorMessage::new("Unable to start window event listener", e))?;
 
     // Determine current time window
     let now = DatabaseTime::from(time::SystemTime::now());
+    let now_instant = time::Instant::now(); // Same time as now, used to start timers.
     let window_start = {
         if let Some((time, durations)) = db.get_last_entry().map_err(|e| {
             ErrorMessage::new(format!("Unable to read last entry of '{}'", db_filename), e)
         })? {
-            if time <= now && now < time + chrono::Duration::from_std(time_window_size).unwrap() {
+            if time <= now && now < time + time_window_duration {
                 // We are still in the time window of the last entry, resume the window.
                 duration_counter.set_durations(durations);
                 time
@@ -194,7 +233,7 @@ fn run_daemon(
     let all_category_changes = active_window_changes
         .map_err(|e| ErrorMessage::new("Window metadata listener failed", e))
         .for_each(|(active_window_metadata, timestamp)| {
-            println!("task_handle_window_change");
+            debug_println!("task_handle_window_change");
             let category = classifier.classify(active_window_metadata)?;
             duration_counter
                 .borrow_mut()
@@ -204,10 +243,10 @@ fn run_daemon(
 
     // Periodically write database to file
     let all_db_writes =
-        tokio::timer::Interval::new(time::Instant::now() + db_write_interval, db_write_interval)
+        tokio::timer::Interval::new(now_instant + db_write_interval, db_write_interval)
             .map_err(|e| ErrorMessage::new("Timer error", e))
             .for_each(|instant| {
-                println!("task_write_db");
+                debug_println!("task_write_db");
                 write_durations_to_disk(
                     &mut db.borrow_mut(),
                     &mut duration_counter.borrow_mut(),
@@ -221,17 +260,17 @@ fn run_daemon(
 
     // Periodically change time window
     let all_time_window_changes = tokio::timer::Interval::new(
-        time::Instant::now() + duration_to_next_window_change,
+        now_instant + duration_to_next_window_change,
         time_window_size,
     )
     .map_err(|e| ErrorMessage::new("Timer error", e))
     .for_each(|instant| {
-        println!("task_new_time_window");
+        debug_println!("task_new_time_window");
         change_time_window(
             &mut db.borrow_mut(),
             &mut duration_counter.borrow_mut(),
             &mut window_start.borrow_mut(),
-            time_window_size,
+            time_window_duration,
             instant,
         )
         .map_err(|e| ErrorMessage::new(format!("Unable to write to database '{}'", db_filename), e))
@@ -2,12 +2,12 @@
 extern crate mio;
 extern crate xcb; // for xcb_stalker
 
-use std;
 use std::io;
-use std::os::unix::io::AsRawFd;
+use std::os::unix::io::{AsRawFd, RawFd};
 use std::time;
 use tokio::prelude::*;
 use tokio::reactor::PollEvented2 as PollEvented; // Tokio is changing interfaces, temporary
+use tokio::timer::Delay;
 
 /// This is the type used to output information about the active window.
 /// Defined in main.
@@ -17,9 +17,11 @@ pub use super::ActiveWindowMetadata;
 /// Owns the connection to the X server.
 struct Stalker {
     connection: xcb::Connection,
+    connection_fd: RawFd, // Fixed for the connection lifetime
     root_window: xcb::Window,
     non_static_atoms: NonStaticAtoms,
     current_active_window: xcb::Window,
+    current_class: Option<Option<String>>, // WM_CLASS of current_active_window, None if unknown
 }
 
 /// Store non static useful atoms (impl detail of Stalker).
@@ -108,8 +110,10 @@ impl Stalker {
 
         let active_window = get_active_window(&conn, root_window, non_static_atoms.active_window)?;
 
-        // Listen to its title changes
-        enable_property_change_notifications(&conn, active_window);
+        // Listen to its title changes (if there is one, and not root which is done below)
+        if active_window != xcb::NONE && active_window != root_window {
+            enable_property_change_notifications(&conn, active_window);
+        }
 
         // Listen to property changes for root window.
         // This is where the active window property is maintained.
@@ -119,29 +123,57 @@ impl Stalker {
         conn.has_error().map_err(conn_to_io_error)?;
 
         Ok(Stalker {
+            connection_fd: conn.as_raw_fd(),
             connection: conn,
             root_window: root_window,
             non_static_atoms: non_static_atoms,
             current_active_window: active_window,
+            current_class: None,
         })
     }
 
     /// Get the current active window metadata, and timestamp of change.
-    fn get_active_window_metadata(&self) -> io::Result<(ActiveWindowMetadata, time::Instant)> {
+    /// WM_CLASS is only requested if not already known for the current active window.
+    fn get_active_window_metadata(&mut self) -> io::Result<(ActiveWindowMetadata, time::Instant)> {
         // Timestamp from xcb is unusable
         let timestamp = time::Instant::now();
-        // Requests
-        let title = self.get_text_property(self.current_active_window, xcb::ATOM_WM_NAME);
-        let class = self.get_text_property(self.current_active_window, xcb::ATOM_WM_CLASS);
-        // Process replies
-        let title = title.get_reply();
-        let class = class.get_reply().map(|mut text| match text.find('\0') {
-            Some(offset) => {
-                text.truncate(offset);
-                text
-            }
-            None => text,
-        });
+        let window = self.current_active_window;
+        if window == xcb::NONE {
+            // No active window: requests would only fail with BadWindow
+            return Ok((
+                ActiveWindowMetadata {
+                    title: None,
+                    class: None,
+                },
+                timestamp,
+            ));
+        }
+        let fetch_class = self.current_class.is_none();
+        let (title, fetched_class) = {
+            // Requests
+            let title = self.get_text_property(window, xcb::ATOM_WM_NAME);
+            let class = if fetch_class {
+                Some(self.get_text_property(window, xcb::ATOM_WM_CLASS))
+            } else {
+                None
+            };
+            // Process replies
+            let title = title.get_reply();
+            // WM_CLASS is "instance\0class\0": only keep instance, cut before decoding utf8.
+            let class = class.map(|class| {
+                class
+                    .get_bytes_reply_until_nul()
+                    .and_then(|bytes| String::from_utf8(bytes).ok())
+            });
+            (title, class)
+        };
+        if let Some(class) = fetched_class {
+            self.current_class = Some(class);
+        }
+        let class = self
+            .current_class
+            .clone()
+            .expect("class is known at this point");
         Ok((
             ActiveWindowMetadata {
                 title: title,
@@ -158,22 +190,32 @@ impl Stalker {
         let mut active_window_title_changed = false;
         // Process all events, gather changes.
         while let Some(event) = self.connection.poll_for_event() {
-            let rt = event.response_type();
+            // High bit only tells if the event was sent by SendEvent
+            let rt = event.response_type() & !0x80;
             if rt == xcb::PROPERTY_NOTIFY {
                 let event: &xcb::PropertyNotifyEvent = unsafe { xcb::cast_event(&event) };
-                if event.window() == self.root_window
-                    && event.atom() == self.non_static_atoms.active_window
-                    && event.state() == xcb::PROPERTY_NEW_VALUE as u8
-                {
-                    println!("DEBUG: prop change active_window on root");
-                    active_window_changed = true;
+                // Property deletions are not interesting
+                if event.state() != xcb::PROPERTY_NEW_VALUE as u8 {
+                    continue;
                 }
-                if event.window() == self.current_active_window
-                    && event.atom() == xcb::ATOM_WM_NAME
-                    && event.state() == xcb::PROPERTY_NEW_VALUE as u8
-                {
-                    println!("DEBUG: prop change title on active_window");
-                    active_window_title_changed = true;
+                // Most changes are for other properties: reject them on the atom first.
+                let atom = event.atom();
+                if atom == self.non_static_atoms.active_window {
+                    if event.window() == self.root_window {
+                        debug_println!("DEBUG: prop change active_window on root");
+                        active_window_changed = true;
+                    }
+                } else if atom == xcb::ATOM_WM_NAME {
+                    if event.window() == self.current_active_window {
+                        debug_println!("DEBUG: prop change title on active_window");
+                        active_window_title_changed = true;
+                    }
+                } else if atom == xcb::ATOM_WM_CLASS {
+                    if event.window() == self.current_active_window {
+                        // Rare, but the cached class is now outdated.
+                        self.current_class = None;
+                        active_window_title_changed = true;
+                    }
                 }
             }
         }
@@ -181,15 +223,21 @@ impl Stalker {
         if active_window_changed {
             let new_active_window = self.get_active_window()?;
             if new_active_window != self.current_active_window {
-                if self.current_active_window != self.root_window {
+                if self.current_active_window != self.root_window
+                    && self.current_active_window != xcb::NONE
+                {
                     // We do not want to disable notifications for root !
                     disable_property_change_notifications(
                         &self.connection,
                         self.current_active_window,
                     )
                 }
-                enable_property_change_notifications(&self.connection, new_active_window);
+                // Root notifications are always enabled, do not send the mask again.
+                if new_active_window != xcb::NONE && new_active_window != self.root_window {
+                    enable_property_change_notifications(&self.connection, new_active_window);
+                }
                 self.current_active_window = new_active_window;
+                self.current_class = None;
                 return Ok(true);
             }
         }
@@ -227,8 +275,16 @@ impl NonStaticAtoms {
             compound_text: compound_text_cookie.get_reply().map_err(to_error)?.atom(),
         })
     }
+    /// Is atom one of the supported text property types
+    fn is_text_type(&self, atom: xcb::Atom) -> bool {
+        atom == xcb::ATOM_STRING || atom == self.utf8_string || atom == self.compound_text
+    }
 }
 
+/// Text properties are requested by chunks of this length (in 4 bytes units).
+/// Most values fit in the first chunk, the rest is only requested if needed.
+const TEXT_PROPERTY_CHUNK_LEN: u32 = 64;
+
 /// Request a text property, returning a handle on the request.
 fn get_text_property<'a>(
     connection: &'a xcb::Connection,
@@ -237,39 +293,84 @@ fn get_text_property<'a>(
     atom: xcb::Atom,
 ) -> GetTextPropertyCookie<'a> {
     GetTextPropertyCookie {
-        cookie: xcb::get_property(connection, false, window, atom, xcb::ATOM_ANY, 0, 1024),
+        cookie: xcb::get_property(
+            connection,
+            false,
+            window,
+            atom,
+            xcb::ATOM_ANY,
+            0,
+            TEXT_PROPERTY_CHUNK_LEN,
+        ),
+        connection: connection,
         non_static_atoms: non_static_atoms,
+        window: window,
+        atom: atom,
     }
 }
 
 /// Ongoing request for a text property (impl detail of Stalker).
 struct GetTextPropertyCookie<'a> {
     cookie: xcb::GetPropertyCookie<'a>,
+    connection: &'a xcb::Connection,
     non_static_atoms: &'a NonStaticAtoms,
+    window: xcb::Window,
+    atom: xcb::Atom,
 }
 
 impl<'a> GetTextPropertyCookie<'a> {
     /// Retrieve the text property as a String, or None if error.
     fn get_reply(&self) -> Option<String> {
-        if let Ok(reply) = self.cookie.get_reply() {
-            if reply.format() == 8 && reply.bytes_after() == 0 && reply.value_len() > 0 {
-                match reply.type_() {
-                    atom if [
-                        xcb::ATOM_STRING,
-                        self.non_static_atoms.utf8_string,
-                        self.non_static_atoms.compound_text,
-                    ]
-                    .contains(&atom) =>
-                    {
-                        return std::str::from_utf8(reply.value())
-                            .ok()
-                            .map(|text| String::from(text))
-                    }
-                    atom => eprintln!("get_text_property: unsupported atom reply: {}", atom),
-                }
+        self.get_bytes_reply(false)
+            .and_then(|bytes| String::from_utf8(bytes).ok())
+    }
+
+    /// Retrieve the text property bytes before the first NUL, or None if error.
+    /// The full value is only requested if the first chunk contains no NUL.
+    fn get_bytes_reply_until_nul(&self) -> Option<Vec<u8>> {
+        self.get_bytes_reply(true).map(|mut bytes| {
+            if let Some(offset) = bytes.iter().position(|b| *b == 0) {
+                bytes.truncate(offset);
             }
+            bytes
+        })
+    }
+
+    /// Retrieve the text property bytes, or None if error.
+    /// If the value is longer than the first chunk, it is requested again in full (blocking).
+    /// With stop_at_nul, a first chunk containing a NUL is returned as is.
+    fn get_bytes_reply(&self, stop_at_nul: bool) -> Option<Vec<u8>> {
+        let reply = self.cookie.get_reply().ok()?;
+        if !(reply.format() == 8 && reply.value_len() > 0) {
+            return None;
+        }
+        let atom = reply.type_();
+        if !self.non_static_atoms.is_text_type(atom) {
+            eprintln!("get_text_property: unsupported atom reply: {}", atom);
+            return None;
+        }
+        let first_chunk = reply.value::<u8>();
+        if reply.bytes_after() == 0 || (stop_at_nul && first_chunk.contains(&0)) {
+            return Some(first_chunk.to_vec());
+        }
+        // Request the whole value from the start: a single reply cannot mix old and new values.
+        let rest_len = (reply.bytes_after() + 3) / 4;
+        let full = xcb::get_property(
+            self.connection,
+            false,
+            self.window,
+            self.atom,
+            atom,
+            0,
+            TEXT_PROPERTY_CHUNK_LEN + rest_len,
+        )
+        .get_reply()
+        .ok()?;
+        // Property may have grown or changed type in between: then give up.
+        if !(full.format() == 8 && full.type_() == atom && full.bytes_after() == 0) {
+            return None;
         }
-        None
+        Some(full.value::<u8>().to_vec())
     }
 }
 
@@ -282,7 +383,7 @@ impl mio::Evented for Stalker {
         interest: mio::Ready,
         opts: mio::PollOpt,
     ) -> io::Result<()> {
-        mio::unix::EventedFd(&self.connection.as_raw_fd()).register(poll, token, interest, opts)
+        mio::unix::EventedFd(&self.connection_fd).register(poll, token, interest, opts)
     }
 
     fn reregister(
@@ -292,17 +393,25 @@ impl mio::Evented for Stalker {
         interest: mio::Ready,
         opts: mio::PollOpt,
     ) -> io::Result<()> {
-        mio::unix::EventedFd(&self.connection.as_raw_fd()).reregister(poll, token, interest, opts)
+        mio::unix::EventedFd(&self.connection_fd).reregister(poll, token, interest, opts)
     }
 
     fn deregister(&self, poll: &mio::Poll) -> io::Result<()> {
-        mio::unix::EventedFd(&self.connection.as_raw_fd()).deregister(poll)
+        mio::unix::EventedFd(&self.connection_fd).deregister(poll)
     }
 }
 
+/// Delay between the first detected change and the metadata query.
+/// Changes detected during this delay are coalesced (focus changes often come in bursts).
+/// The delay is not extended by later changes, so a stream of changes cannot postpone the query.
+const CHANGE_SETTLE_DELAY: time::Duration = time::Duration::from_millis(20);
+
 /// Asynchronous stream producing ActiveWindowMetadata when active window changes.
+/// Metadata is queried after changes have settled, see CHANGE_SETTLE_DELAY.
 pub struct ActiveWindowChanges {
     inner: PollEvented<Stalker>,
+    last_metadata: Option<ActiveWindowMetadata>, // Last metadata given out, to skip repeats
+    pending_change: Option<Delay>,               // Settle timer of coalesced changes
 }
 
 impl ActiveWindowChanges {
@@ -311,13 +420,17 @@ impl ActiveWindowChanges {
     pub fn new() -> io::Result<Self> {
         Ok(ActiveWindowChanges {
             inner: PollEvented::new(Stalker::new()?),
+            last_metadata: None,
+            pending_change: None,
         })
     }
 
     /// Request the current metadata, irrespective of the stream state.
     /// This can be used for initialisation, before the first change.
-    pub fn get_current_metadata(&self) -> io::Result<(ActiveWindowMetadata, time::Instant)> {
-        self.inner.get_ref().get_active_window_metadata()
+    pub fn get_current_metadata(&mut self) -> io::Result<(ActiveWindowMetadata, time::Instant)> {
+        let (metadata, timestamp) = self.inner.get_mut().get_active_window_metadata()?;
+        self.last_metadata = Some(metadata.clone());
+        Ok((metadata, timestamp))
     }
 }
 
@@ -329,23 +442,41 @@ impl Stream for ActiveWindowChanges {
     fn poll(&mut self) -> Poll<Option<Self::Item>, io::Error> {
         // Check if there is inbound data (xcb events to process)
         match self.inner.poll_read_ready(mio::Ready::readable()) {
-            Ok(Async::Ready(_)) => (),
-            Ok(Async::NotReady) => return Ok(Async::NotReady),
+            Ok(Async::Ready(_)) => {
+                // Read all events
+                let active_window_changed = self.inner.get_mut().process_events()?;
+
+                // Reset read flag, will be set again if data arrives on socket
+                self.inner.clear_read_ready(mio::Ready::readable())?;
+
+                if active_window_changed && self.pending_change.is_none() {
+                    let deadline = time::Instant::now() + CHANGE_SETTLE_DELAY;
+                    self.pending_change = Some(Delay::new(deadline));
+                }
+            }
+            Ok(Async::NotReady) => (),
             Err(e) => return Err(e),
         }
-        // Read all events
-        let active_window_changed = self.inner.get_mut().process_events()?;
-
-        // Reset read flag, will be set again if data arrives on socket
-        self.inner.clear_read_ready(mio::Ready::readable())?;
+        // Wait for a pending change to settle.
+        match &mut self.pending_change {
+            Some(settle_timer) => match settle_timer.poll() {
+                Ok(Async::Ready(())) => (),
+                Ok(Async::NotReady) => return Ok(Async::NotReady),
+                Err(e) => return Err(io::Error::new(io::ErrorKind::Other, e)),
+            },
+            None => return Ok(Async::NotReady),
+        }
+        self.pending_change = None;
 
-        if active_window_changed {
-            // get_active_window_metadata requests replies are all consumed
-            Ok(Async::Ready(Some(
-                self.inner.get_ref().get_active_window_metadata()?,
-            )))
-        } else {
-            Ok(Async::NotReady)
+        // get_active_window_metadata requests replies are all consumed.
+        // The change is timestamped now, at settle time and not when first detected:
+        // timer tasks may have recorded durations in between, and timestamps must not go back.
+        let (metadata, timestamp) = self.inner.get_mut().get_active_window_metadata()?;
+        // Only give out actual changes: same metadata would be classified the same way.
+        if self.last_metadata.as_ref() != Some(&metadata) {
+            self.last_metadata = Some(metadata.clone());
+            return Ok(Async::Ready(Some((metadata, timestamp))));
         }
+        Ok(Async::NotReady)
     }
 }